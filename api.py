@@ -4,28 +4,49 @@ PACS Imago Radiologia API
 This module provides a FastAPI-based API for the PACS Imago Radiologia automation.
 """
 import os
-import json
 import uuid
 import asyncio
-from typing import Optional, Dict, Any, List
+from contextlib import asynccontextmanager
+from typing import Optional, Dict, Any, AsyncIterator, List, Tuple
 
-from fastapi import FastAPI, HTTPException, BackgroundTasks
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, Header, HTTPException, WebSocket, WebSocketDisconnect
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
 from pydantic import BaseModel, Field
 
+import orjson
 from dotenv import load_dotenv
-from login_automation import login_to_pacs
+from login_automation import DEFAULT_FILTER_OPTIONS
+from task_store import (
+    create_redis, save_task, load_task, task_key, done_channel, events_channel,
+    claim_inflight, release_inflight, request_fingerprint, save_credentials, credentials_key, finish_task
+)
+from worker import scrape_job, SCRAPE_TIME_LIMIT
 
 # Load environment variables
 load_dotenv()
 
-# Dictionary to store task status
-task_storage = {}
+# Number of rows encoded per chunk when /scrape_sync streams NDJSON
+NDJSON_BATCH_SIZE = 500
+
+# Maximum time to wait for a task to complete (seconds): the job time limit plus time spent queued
+TASK_WAIT_TIMEOUT = SCRAPE_TIME_LIMIT / 1000 + 120
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Opens the Redis connection used to store task status."""
+    app.state.redis = create_redis()
+    try:
+        yield
+    finally:
+        await app.state.redis.aclose()
 
 app = FastAPI(
     title="PACS IMAGO - TOTEM API",
-    description="API for NETRIS' TOTEM - Version: 1.0.0"
+    description="API for NETRIS' TOTEM - Version: 1.0.0",
+    default_response_class=ORJSONResponse,
+    lifespan=lifespan
 )
 
 # Add CORS middleware
@@ -37,62 +58,98 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Compress large responses (scraped tables compress very well)
+app.add_middleware(GZipMiddleware, minimum_size=1024, compresslevel=5)
+
 # Data models
 class FilterOptions(BaseModel):
-    grupo_totem: Optional[str] = "Selecione um grupo totem"
-    guiche: Optional[str] = "Selecione um guichê"
-    tipo: Optional[str] = "Selecione um tipo"
-    prioridade: Optional[str] = "Selecione uma prioridade"
-    modalidade: Optional[str] = "Selecione uma modalidade"
+    grupo_totem: Optional[str] = DEFAULT_FILTER_OPTIONS["grupo_totem"]
+    guiche: Optional[str] = DEFAULT_FILTER_OPTIONS["guiche"]
+    tipo: Optional[str] = DEFAULT_FILTER_OPTIONS["tipo"]
+    prioridade: Optional[str] = DEFAULT_FILTER_OPTIONS["prioridade"]
+    modalidade: Optional[str] = DEFAULT_FILTER_OPTIONS["modalidade"]
 
 class ScrapingRequest(BaseModel):
-    j_username: str = Field(..., description="Username for PACS login")
-    j_password: str = Field(..., description="Password for PACS login")
-    filter_options: Optional[FilterOptions] = None
+    j_username: str = Field(..., min_length=1, description="Username for PACS login")
+    j_password: str = Field(..., min_length=1, description="Password for PACS login")
+    filter_options: Optional[FilterOptions] = Field(default_factory=FilterOptions)
     headless: bool = True
     viewport_width: int = 1280
     viewport_height: int = 800
 
-async def run_scraping_task(task_id: str, request: ScrapingRequest):
-    """Background task to run the scraping process"""
+async def start_scraping_task(request: ScrapingRequest) -> Tuple[str, bool]:
+    """
+    Queues a scraping task for a worker, unless an identical one is already running.
+    
+    Returns:
+        The task ID and whether a new task was started
+    """
+    redis = app.state.redis
+    
+    # Generate a unique task ID
+    task_id = f"task_{uuid.uuid4().hex}"
+    payload = request.model_dump()
+    
+    # Initialize task status
+    await save_task(redis, task_id, {
+        "status": "running",
+        "message": "Scraping task started in the background",
+        "data": []
+    })
+    
+    # Reuse the task already running an identical request instead of starting a new one
+    fingerprint = request_fingerprint(payload)
+    running_id = await claim_inflight(redis, fingerprint, task_id)
+    if running_id is not None:
+        await redis.delete(task_key(task_id))
+        return running_id, False
+    
+    # Queue the task for a worker, keeping the credentials out of the message
     try:
-        # Temporarily set environment variables for login function
-        os.environ["j_username"] = request.j_username
-        os.environ["j_password"] = request.j_password
-        
-        # Call the automation function with parameters
-        filter_options = None
-        if request.filter_options:
-            filter_options = {
-                "grupo_totem": request.filter_options.grupo_totem,
-                "guiche": request.filter_options.guiche,
-                "tipo": request.filter_options.tipo,
-                "prioridade": request.filter_options.prioridade,
-                "modalidade": request.filter_options.modalidade,
-            }
-        
-        # Run the automation and get results
-        result = await login_to_pacs(
-            headless=request.headless,
-            viewport_width=request.viewport_width,
-            viewport_height=request.viewport_height,
-            filter_options=filter_options
-        )
-        
-        # Clear environment variables after use
-        os.environ.pop("j_username", None)
-        os.environ.pop("j_password", None)
-        
-        # Update task status with result
-        task_storage[task_id] = result
-        
+        await save_credentials(redis, task_id, payload.pop("j_username"), payload.pop("j_password"))
+        await asyncio.get_running_loop().run_in_executor(None, scrape_job.send, task_id, fingerprint, payload)
     except Exception as e:
-        # Update task status with error
-        task_storage[task_id] = {
+        # Don't leave identical requests waiting on a task that will never run
+        await redis.delete(credentials_key(task_id))
+        await finish_task(redis, task_id, {
             "status": "failed",
-            "message": str(e),
+            "message": f"Could not queue scraping task: {e}",
             "data": []
-        }
+        })
+        await release_inflight(redis, fingerprint, task_id)
+        raise
+    return task_id, True
+
+async def iter_ndjson(rows: List[Dict[str, Any]]) -> AsyncIterator[bytes]:
+    """Encodes rows as NDJSON (one JSON row per line), a batch of rows per chunk."""
+    for start in range(0, len(rows), NDJSON_BATCH_SIZE):
+        yield b"".join(orjson.dumps(row) + b"\n" for row in rows[start:start + NDJSON_BATCH_SIZE])
+
+async def wait_for_task(task_id: str) -> Optional[Dict[str, Any]]:
+    """
+    Waits until a task reaches a final state and returns its status.
+    
+    Raises:
+        asyncio.TimeoutError: If the task is still running after TASK_WAIT_TIMEOUT seconds
+    """
+    redis = app.state.redis
+    pubsub = redis.pubsub()
+    
+    async def wait_for_done() -> None:
+        async for message in pubsub.listen():
+            if message["type"] == "message":
+                return
+    
+    # Subscribe before reading the status so a completion in between is not missed
+    await pubsub.subscribe(done_channel(task_id))
+    try:
+        task = await load_task(redis, task_id)
+        if task is not None and task["status"] == "running":
+            await asyncio.wait_for(wait_for_done(), TASK_WAIT_TIMEOUT)
+            task = await load_task(redis, task_id)
+        return task
+    finally:
+        await pubsub.aclose()
 
 @app.get("/")
 async def root():
@@ -104,15 +161,16 @@ async def root():
             {"path": "/", "method": "GET", "description": "API information"},
             {"path": "/scrape", "method": "POST", "description": "Scrape data from PACS system (asynchronous)"},
             {"path": "/scrape_sync", "method": "POST", "description": "Scrape data from PACS system (synchronous, waits for completion)"},
-            {"path": "/task/{task_id}", "method": "GET", "description": "Get status of a scraping task"}
+            {"path": "/task/{task_id}", "method": "GET", "description": "Get status of a scraping task"},
+            {"path": "/ws/task/{task_id}", "method": "WEBSOCKET", "description": "Receive progress events and the result of a scraping task as soon as it completes"}
         ]
     }
 
 @app.post("/scrape")
-async def scrape_data(request: ScrapingRequest, background_tasks: BackgroundTasks):
+async def scrape_data(request: ScrapingRequest):
     """
     Endpoint to scrape data from the PACS system asynchronously.
-    This starts a background task and returns a task ID immediately.
+    This queues the task for a worker and returns a task ID immediately.
     
     Required parameters:
     - j_username: Username for PACS login
@@ -124,17 +182,15 @@ async def scrape_data(request: ScrapingRequest, background_tasks: BackgroundTask
     - viewport_width: Width of browser viewport
     - viewport_height: Height of browser viewport
     """
-    # Generate a unique task ID
-    task_id = f"task_{uuid.uuid4().hex}"
-    # Initialize task status
-    task_storage[task_id] = {
-        "status": "running",
-        "message": "Scraping task started in the background",
-        "data": []
-    }
-    
-    # Start background task
-    background_tasks.add_task(run_scraping_task, task_id, request)
+    task_id, started = await start_scraping_task(request)
+    if not started:
+        return [
+            {
+                "task_id": task_id,
+                "status": "running",
+                "message": "Identical scraping task already running"
+            }
+        ]
     
     # Return task ID and status
     return [
@@ -146,10 +202,11 @@ async def scrape_data(request: ScrapingRequest, background_tasks: BackgroundTask
     ]
 
 @app.post("/scrape_sync")
-async def scrape_data_sync(request: ScrapingRequest):
+async def scrape_data_sync(request: ScrapingRequest, accept: Optional[str] = Header(None)):
     """
     Endpoint to scrape data from the PACS system synchronously.
-    This waits for the scraping process to complete before returning the results.
+    This queues the task for a worker and waits for it to complete before returning the results.
+    Clients sending "Accept: application/x-ndjson" get the rows streamed as NDJSON (one row per line).
     
     Required parameters:
     - j_username: Username for PACS login
@@ -162,45 +219,41 @@ async def scrape_data_sync(request: ScrapingRequest):
     - viewport_height: Height of browser viewport
     """
     try:
-        # Temporarily set environment variables for login function
-        os.environ["j_username"] = request.j_username
-        os.environ["j_password"] = request.j_password
-        
-        # Call the automation function with parameters
-        filter_options = None
-        if request.filter_options:
-            filter_options = {
-                "grupo_totem": request.filter_options.grupo_totem,
-                "guiche": request.filter_options.guiche,
-                "tipo": request.filter_options.tipo,
-                "prioridade": request.filter_options.prioridade,
-                "modalidade": request.filter_options.modalidade,
-            }
-        
-        # Run the automation and get results
-        result = await login_to_pacs(
-            headless=request.headless,
-            viewport_width=request.viewport_width,
-            viewport_height=request.viewport_height,
-            filter_options=filter_options
-        )
-        
-        # Clear environment variables after use
-        os.environ.pop("j_username", None)
-        os.environ.pop("j_password", None)
+        # Run the automation on a worker and wait for its result
+        task_id, _ = await start_scraping_task(request)
+        try:
+            result = await wait_for_task(task_id)
+        except asyncio.TimeoutError:
+            # The task may still finish, its result can then be fetched from /task/{task_id}
+            return ORJSONResponse(
+                status_code=504,
+                content={
+                    "task_id": task_id,
+                    "status": "running",
+                    "message": f"Task did not complete within {TASK_WAIT_TIMEOUT:.0f} seconds",
+                    "data": []
+                }
+            )
+        if result is None:
+            raise RuntimeError(f"Task {task_id} not found")
         
         # Return the result directly
         if result["status"] == "success":
-            return result["data"]
+            rows = result["data"]
+            
+            # Stream the rows one JSON row per line if the client asked for it
+            if accept and "application/x-ndjson" in accept:
+                return StreamingResponse(iter_ndjson(rows), media_type="application/x-ndjson")
+            return rows
         else:
-            return JSONResponse(
+            return ORJSONResponse(
                 status_code=500,
                 content=result
             )
         
     except Exception as e:
         # Handle exceptions
-        return JSONResponse(
+        return ORJSONResponse(
             status_code=500,
             content={
                 "status": "failed",
@@ -217,11 +270,68 @@ async def get_task_status(task_id: str):
     Parameters:
     - task_id: The ID of the task to check
     """
-    if task_id not in task_storage:
+    task = await load_task(app.state.redis, task_id)
+    if task is None:
         raise HTTPException(status_code=404, detail=f"Task {task_id} not found")
     
-    return task_storage[task_id]
+    return task
+
+@app.websocket("/ws/task/{task_id}")
+async def task_updates(websocket: WebSocket, task_id: str):
+    """
+    WebSocket endpoint that streams the progress of a scraping task.
+    Progress events ("status": "running" with a "stage") are sent as they happen,
+    followed by the final status as soon as the task completes.
+    
+    Parameters:
+    - task_id: The ID of the task to follow
+    """
+    await websocket.accept()
+    redis = app.state.redis
+    pubsub = redis.pubsub()
+    
+    async def relay_until_done() -> None:
+        async for message in pubsub.listen():
+            if message["type"] != "message":
+                continue
+            if message["channel"] == done_channel(task_id):
+                return
+            # Relay progress events as they are published
+            await websocket.send_text(message["data"])
+    
+    # Subscribe before reading the status so a completion in between is not missed
+    await pubsub.subscribe(done_channel(task_id), events_channel(task_id))
+    try:
+        task = await load_task(redis, task_id)
+        if task is not None and task["status"] == "running":
+            try:
+                await asyncio.wait_for(relay_until_done(), TASK_WAIT_TIMEOUT)
+            except asyncio.TimeoutError:
+                await websocket.close(code=4408, reason=f"Task did not complete within {TASK_WAIT_TIMEOUT:.0f} seconds")
+                return
+            task = await load_task(redis, task_id)
+        
+        if task is None:
+            await websocket.close(code=4404, reason=f"Task {task_id} not found")
+            return
+        
+        await websocket.send_text(orjson.dumps(task).decode())
+        await websocket.close()
+        
+    except WebSocketDisconnect:
+        pass
+    finally:
+        await pubsub.aclose()
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    # Task state lives in Redis, so several worker processes can serve the API
+    uvicorn.run(
+        "api:app",
+        host="0.0.0.0",
+        port=8000,
+        workers=int(os.getenv("WEB_CONCURRENCY", os.cpu_count() or 1)),
+        loop="uvloop",
+        http="httptools",
+        log_level="info"
+    )
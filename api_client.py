@@ -1,63 +1,130 @@
 #!/usr/bin/env python
 """
 PACS Imago Radiologia API Client
-This script provides a client for the PACS Imago Radiologia API that polls until results are ready.
+This script provides a client for the PACS Imago Radiologia API that waits until results are ready.
 """
 import sys
-import time
-import json
-import requests
+import logging
+import random
+import orjson
+import asyncio
+import httpx
+import websockets
 from typing import Dict, Any, Optional
 import argparse
+from types import MappingProxyType
+
+# Progress messages go to stderr, so stdout only carries the result
+log = logging.getLogger("pacs_client")
 
 # Base URL for the API
 API_URL = "https://api-manager-api-totem-ris.uzfqiw.easypanel.host"
 
-def poll_until_complete(task_id: str, max_retries: int = 30, delay: int = 5) -> Dict[str, Any]:
+# Filter values that leave every dropdown unfiltered
+_DEFAULT_FILTERS = MappingProxyType({
+    "grupo_totem": "Selecione um grupo totem",
+    "guiche": "Selecione um guichê",
+    "tipo": "Selecione um tipo",
+    "prioridade": "Selecione uma prioridade",
+    "modalidade": "Selecione uma modalidade"
+})
+
+# Formatting used when writing results
+JSON_OPTIONS = orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS
+
+# Initial delay in seconds between polls, doubled on every attempt
+POLL_BASE_DELAY = 0.5
+
+# Default timeout in seconds for HTTP requests (5 seconds to connect)
+REQUEST_TIMEOUT = httpx.Timeout(30, connect=5)
+
+# Connection pool shared by all requests made through a client
+CONNECTION_LIMITS = httpx.Limits(max_connections=8, max_keepalive_connections=4)
+
+# Maximum time in seconds to wait for a pushed result: the server's job time limit (SCRAPE_TIME_LIMIT, 600 s)
+# plus the time it allows for queueing (120 s), with a margin so the server gives up first
+PUSH_TIMEOUT = 600 + 120 + 30
+
+# Base URL for the WebSocket endpoints
+WS_URL = API_URL.replace("https://", "wss://", 1).replace("http://", "ws://", 1)
+
+def create_client() -> httpx.AsyncClient:
+    """
+    Create the HTTP client used to talk to the API.
+    Requests share pooled HTTP/2 connections, so concurrent polls are multiplexed on one connection.
+    
+    Returns:
+        A new AsyncClient, to be used as an async context manager
+    """
+    transport = httpx.AsyncHTTPTransport(http2=True, retries=3, limits=CONNECTION_LIMITS)
+    return httpx.AsyncClient(timeout=REQUEST_TIMEOUT, transport=transport)
+
+def backoff_delay(attempt: int, max_delay: float) -> float:
+    """
+    Compute the delay before the next poll using exponential backoff with jitter.
+    
+    Args:
+        attempt: Number of polls already made (starting at 0)
+        max_delay: Upper bound in seconds for the backoff
+        
+    Returns:
+        The delay in seconds
+    """
+    return min(max_delay, POLL_BASE_DELAY * 2 ** attempt) + random.uniform(0, 0.25 * POLL_BASE_DELAY)
+
+async def poll_until_complete(client: httpx.AsyncClient, task_id: str,
+                              max_retries: int = 30, delay: float = 10) -> Dict[str, Any]:
     """
     Poll the API until the task is complete or max retries are reached.
+    Polls start quickly and back off exponentially so short tasks are picked up fast.
     
     Args:
+        client: HTTP client used for the requests
         task_id: The task ID to poll for
         max_retries: Maximum number of retry attempts
-        delay: Delay in seconds between retries
+        delay: Maximum delay in seconds between retries
         
     Returns:
         The final API response or an error if max retries reached
     """
-    print(f"Polling for task {task_id}...")
+    log.info("Polling for task %s...", task_id)
     
     # Endpoint to check task status
     status_url = f"{API_URL}/task/{task_id}"
     
     for attempt in range(1, max_retries + 1):
+        wait = backoff_delay(attempt - 1, delay)
         try:
-            print(f"Attempt {attempt}/{max_retries}...")
-            response = requests.get(status_url)
+            log.info("Attempt %d/%d...", attempt, max_retries)
+            response = await client.get(status_url)
             
             if response.status_code == 200:
                 data = response.json()
                 
                 # Check if task is complete
                 if data.get("status") == "success":
-                    print("Task completed successfully!")
+                    log.info("Task completed successfully!")
                     return data
                 elif data.get("status") == "failed":
-                    print(f"Task failed: {data.get('message')}")
+                    log.warning("Task failed: %s", data.get("message"))
                     return data
                 else:
-                    print(f"Task still running. Status: {data.get('status')}, Message: {data.get('message')}")
-                    
-                    # Wait before the next attempt
-                    print(f"Waiting {delay} seconds before next check...")
-                    time.sleep(delay)
+                    log.info("Task still running. Status: %s, Message: %s", data.get("status"), data.get("message"))
             else:
-                print(f"Error: HTTP {response.status_code} - {response.text}")
-                time.sleep(delay)
+                log.warning("Error: HTTP %d - %s", response.status_code, response.text)
+            
+            # Honor the server's Retry-After hint when present
+            retry_after = response.headers.get("Retry-After", "")
+            if retry_after.isdigit():
+                wait = float(retry_after)
                 
         except Exception as e:
-            print(f"Error during polling: {str(e)}")
-            time.sleep(delay)
+            log.warning("Error during polling: %s", e)
+        
+        # Wait before the next attempt
+        if attempt < max_retries:
+            log.info("Waiting %.1f seconds before next check...", wait)
+            await asyncio.sleep(wait)
     
     return {
         "status": "timeout",
@@ -65,32 +132,100 @@ def poll_until_complete(task_id: str, max_retries: int = 30, delay: int = 5) ->
         "data": []
     }
 
-def scrape_data(username: str, password: str, headless: bool = True, 
-                viewport_width: int = 1280, viewport_height: int = 800,
-                filter_options: Optional[Dict[str, str]] = None) -> Dict[str, Any]:
+async def receive_result(ws) -> Dict[str, Any]:
+    """
+    Print the progress events pushed over a task's WebSocket until its final status arrives.
+    
+    Args:
+        ws: The open WebSocket connection for the task
+        
+    Returns:
+        The final API response
+    """
+    async for message in ws:
+        data = orjson.loads(message)
+        if data.get("status") != "running":
+            return data
+        log.info("Progress: %s", data.get("stage"))
+    
+    raise ConnectionError("WebSocket closed before the task completed")
+
+async def wait_for_push(task_id: str, timeout: float) -> Dict[str, Any]:
     """
-    Initiate a scraping task and poll until completion.
+    Wait for the API to push the final result of a task over its WebSocket.
     
     Args:
+        task_id: The task ID to wait for
+        timeout: Maximum time in seconds to wait for the result
+        
+    Returns:
+        The final API response
+    """
+    # Results can be large, so lift the default 1 MiB message limit
+    async with websockets.connect(f"{WS_URL}/ws/task/{task_id}", max_size=None) as ws:
+        return await asyncio.wait_for(receive_result(ws), timeout)
+
+async def wait_until_complete(client: httpx.AsyncClient, task_id: str,
+                              max_retries: int = 30, delay: float = 10,
+                              timeout: float = PUSH_TIMEOUT) -> Dict[str, Any]:
+    """
+    Wait for a task to complete, using the WebSocket endpoint and falling back to polling.
+    
+    Args:
+        client: HTTP client used when falling back to polling
+        task_id: The task ID to wait for
+        max_retries: Maximum number of retry attempts when polling
+        delay: Maximum delay in seconds between retries when polling
+        timeout: Maximum time in seconds to wait for the result over the WebSocket
+        
+    Returns:
+        The final API response or an error if the task did not complete in time
+    """
+    log.info("Waiting for task %s...", task_id)
+    
+    try:
+        data = await wait_for_push(task_id, timeout)
+        if data.get("status") == "success":
+            log.info("Task completed successfully!")
+        else:
+            log.warning("Task failed: %s", data.get("message"))
+        return data
+    except asyncio.TimeoutError:
+        return {
+            "status": "timeout",
+            "message": f"Task did not complete within {timeout} seconds",
+            "data": []
+        }
+    except Exception as e:
+        log.warning("WebSocket unavailable (%s), falling back to polling...", e)
+        return await poll_until_complete(client, task_id, max_retries, delay)
+
+async def scrape_data(client: httpx.AsyncClient, username: str, password: str, headless: bool = True, 
+                      viewport_width: int = 1280, viewport_height: int = 800,
+                      filter_options: Optional[Dict[str, str]] = None,
+                      max_retries: int = 30, delay: float = 10,
+                      timeout: float = PUSH_TIMEOUT) -> Dict[str, Any]:
+    """
+    Initiate a scraping task and wait until completion.
+    
+    Args:
+        client: HTTP client used for the requests
         username: PACS username
         password: PACS password
         headless: Whether to run browser in headless mode
         viewport_width: Width of browser viewport
         viewport_height: Height of browser viewport
         filter_options: Dictionary with filter options for dropdowns
+        max_retries: Maximum number of retry attempts when polling
+        delay: Maximum delay in seconds between retries when polling
+        timeout: Maximum time in seconds to wait for the result over the WebSocket
         
     Returns:
         The final result data
     """
     # Default filter options if none provided
     if filter_options is None:
-        filter_options = {
-            "grupo_totem": "Selecione um grupo totem",
-            "guiche": "Selecione um guichê",
-            "tipo": "Selecione um tipo",
-            "prioridade": "Selecione uma prioridade",
-            "modalidade": "Selecione uma modalidade"
-        }
+        filter_options = dict(_DEFAULT_FILTERS)
     
     # Prepare the request payload
     payload = {
@@ -103,9 +238,9 @@ def scrape_data(username: str, password: str, headless: bool = True,
     }
     
     # Make the initial request to start scraping
-    print("Starting scraping task...")
+    log.info("Starting scraping task...")
     try:
-        response = requests.post(f"{API_URL}/scrape", json=payload)
+        response = await client.post(f"{API_URL}/scrape", json=payload)
         
         if response.status_code == 200:
             data = response.json()
@@ -113,13 +248,13 @@ def scrape_data(username: str, password: str, headless: bool = True,
             # Check if this is the final result or a task ID
             if isinstance(data, list) and len(data) > 0 and "task_id" in data[0]:
                 task_id = data[0]["task_id"]
-                print(f"Received task ID: {task_id}")
+                log.info("Received task ID: %s", task_id)
                 
-                # Poll until task is complete
-                return poll_until_complete(task_id)
+                # Wait until task is complete
+                return await wait_until_complete(client, task_id, max_retries, delay, timeout)
             else:
                 # Immediate result
-                print("Received immediate result")
+                log.info("Received immediate result")
                 return {
                     "status": "success",
                     "data": data,
@@ -127,7 +262,7 @@ def scrape_data(username: str, password: str, headless: bool = True,
                 }
         else:
             error_msg = f"Error: HTTP {response.status_code} - {response.text}"
-            print(error_msg)
+            log.error(error_msg)
             return {
                 "status": "failed",
                 "message": error_msg,
@@ -136,13 +271,26 @@ def scrape_data(username: str, password: str, headless: bool = True,
             
     except Exception as e:
         error_msg = f"Error initiating scraping: {str(e)}"
-        print(error_msg)
+        log.error(error_msg)
         return {
             "status": "failed",
             "message": error_msg,
             "data": []
         }
 
+async def run_scraping(**kwargs: Any) -> Dict[str, Any]:
+    """
+    Open an HTTP client and run a scraping task with it.
+    
+    Args:
+        **kwargs: Arguments passed on to scrape_data
+        
+    Returns:
+        The final result data
+    """
+    async with create_client() as client:
+        return await scrape_data(client, **kwargs)
+
 def main():
     """Main function to parse arguments and execute the script."""
     parser = argparse.ArgumentParser(description="Client for PACS Imago Radiologia API")
@@ -152,18 +300,27 @@ def main():
     parser.add_argument("--viewport-width", type=int, default=1280, help="Browser viewport width")
     parser.add_argument("--viewport-height", type=int, default=800, help="Browser viewport height")
     parser.add_argument("--output", "-o", help="Output JSON file (optional)")
-    parser.add_argument("--max-retries", type=int, default=30, help="Maximum retry attempts")
-    parser.add_argument("--delay", type=int, default=5, help="Delay between retries in seconds")
+    parser.add_argument("--max-retries", type=int, default=30, help="Maximum retry attempts when falling back to polling")
+    parser.add_argument("--delay", type=float, default=10, help="Maximum delay between retries in seconds")
+    parser.add_argument("--timeout", type=float, default=PUSH_TIMEOUT, help="Maximum time to wait for the result in seconds")
+    parser.add_argument("--quiet", "-q", action="store_true", help="Only log warnings and errors")
     
     # Filter options
-    parser.add_argument("--grupo-totem", default="Selecione um grupo totem", help="Grupo totem filter")
-    parser.add_argument("--guiche", default="Selecione um guichê", help="Guichê filter")
-    parser.add_argument("--tipo", default="Selecione um tipo", help="Tipo filter")
-    parser.add_argument("--prioridade", default="Selecione uma prioridade", help="Prioridade filter")
-    parser.add_argument("--modalidade", default="Selecione uma modalidade", help="Modalidade filter")
+    parser.add_argument("--grupo-totem", default=_DEFAULT_FILTERS["grupo_totem"], help="Grupo totem filter")
+    parser.add_argument("--guiche", default=_DEFAULT_FILTERS["guiche"], help="Guichê filter")
+    parser.add_argument("--tipo", default=_DEFAULT_FILTERS["tipo"], help="Tipo filter")
+    parser.add_argument("--prioridade", default=_DEFAULT_FILTERS["prioridade"], help="Prioridade filter")
+    parser.add_argument("--modalidade", default=_DEFAULT_FILTERS["modalidade"], help="Modalidade filter")
     
     args = parser.parse_args()
     
+    # Configure progress logging
+    logging.basicConfig(
+        stream=sys.stderr,
+        level=logging.WARNING if args.quiet else logging.INFO,
+        format="%(message)s"
+    )
+    
     # Prepare filter options
     filter_options = {
         "grupo_totem": args.grupo_totem,
@@ -174,24 +331,27 @@ def main():
     }
     
     # Run the scraping process
-    result = scrape_data(
+    result = asyncio.run(run_scraping(
         username=args.username,
         password=args.password,
         headless=args.headless,
         viewport_width=args.viewport_width,
         viewport_height=args.viewport_height,
-        filter_options=filter_options
-    )
+        filter_options=filter_options,
+        max_retries=args.max_retries,
+        delay=args.delay,
+        timeout=args.timeout
+    ))
     
     # Output the result
     if args.output:
         # Save to file
-        with open(args.output, 'w', encoding='utf-8') as f:
-            json.dump(result, f, ensure_ascii=False, indent=2)
-        print(f"Results saved to {args.output}")
+        with open(args.output, 'wb') as f:
+            f.write(orjson.dumps(result, option=JSON_OPTIONS))
+        log.info("Results saved to %s", args.output)
     else:
         # Print to console
-        print(json.dumps(result, ensure_ascii=False, indent=2))
+        print(orjson.dumps(result, option=JSON_OPTIONS).decode())
     
     # Exit with appropriate code
     if result["status"] == "success":
@@ -4,21 +4,48 @@ Playwright Inspector Mode Script
 This script launches Playwright in debug mode with the Inspector enabled
 to help identify elements on the page.
 """
-import os
+import json
 import asyncio
-from dotenv import load_dotenv
-from playwright.async_api import async_playwright
+from playwright.async_api import async_playwright, Response
 
-# Load environment variables from .env file
-load_dotenv()
+# Credentials and URLs are shared with the automation script
+from login_automation import USERNAME, PASSWORD, LOGIN_URL, TOTEM_URL
 
-# Get credentials from environment variables
-USERNAME = os.getenv("j_username")
-PASSWORD = os.getenv("j_password")
+# File where the XHR/fetch traffic of the session is recorded, one JSON object per line
+CAPTURE_FILE = "xhr_capture.jsonl"
 
-# URLs
-LOGIN_URL = "https://pacs.imagoradiologia.com.br/Netris-web/login"
-TOTEM_URL = "https://pacs.imagoradiologia.com.br/Netris-web/gerenciamentoTotem/atendimentosTotemPorChegada"
+async def record_xhr(response: Response):
+    """
+    Records an XHR/fetch exchange to CAPTURE_FILE.
+    The captured URLs and payloads (e.g. the request that fills #dataTableAtendimentosTotem)
+    are what is needed to query the site over plain HTTP instead of driving the browser.
+    """
+    request = response.request
+    if request.resource_type not in ("xhr", "fetch"):
+        return
+    
+    try:
+        body = await response.text()
+    except Exception:
+        body = None
+    
+    entry = {
+        "method": request.method,
+        "url": request.url,
+        "request_headers": {k: v for k, v in (await request.all_headers()).items() if k != "cookie"},
+        "post_data": request.post_data,
+        "status": response.status,
+        "content_type": response.headers.get("content-type"),
+        "body": body[:5000] if body else body
+    }
+    
+    # Never write credentials or session cookies to disk
+    if entry["post_data"] and "j_password" in entry["post_data"]:
+        entry["post_data"] = "<login form omitted>"
+    
+    with open(CAPTURE_FILE, "a", encoding="utf-8") as f:
+        f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+    print(f"Captured {request.method} {request.url} -> {response.status}")
 
 async def run_with_inspector():
     """
@@ -38,6 +65,10 @@ async def run_with_inspector():
         # Open a new page
         page = await context.new_page()
         
+        # Record the AJAX calls made by the page
+        print(f"Recording XHR/fetch traffic to {CAPTURE_FILE}...")
+        page.on("response", record_xhr)
+        
         try:
             # Navigate to the login page
             print(f"Navigating to {LOGIN_URL}...")
@@ -101,7 +132,7 @@ async def run_with_inspector():
 
 if __name__ == "__main__":
     # Check if credentials are set in environment variables
-    if not os.getenv("j_username") or not os.getenv("j_password"):
+    if not USERNAME or not PASSWORD:
         print("Warning: j_username and/or j_password not found in environment variables.")
         print("Please add them to your .env file in the format:")
         print("j_username=your_username")
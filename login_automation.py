@@ -5,12 +5,20 @@ This script automates the login process for the PACS Imago Radiologia website.
 """
 import os
 import asyncio
+import uvloop
+import orjson
+import aiofiles
 import csv
-import json
+import uuid
 import datetime
+import socket
+from types import MappingProxyType
+from urllib.parse import urlparse
+from contextlib import AsyncExitStack
 from dotenv import load_dotenv
-from playwright.async_api import async_playwright
-from typing import Dict, Any, Optional
+from playwright.async_api import async_playwright, Browser, CDPSession, Playwright, Response, Route
+from playwright.async_api import Error as PlaywrightError, TimeoutError as PlaywrightTimeoutError
+from typing import Dict, Any, List, Optional, Callable, Awaitable, Tuple
     
 # Load environment variables from .env file
 load_dotenv()
@@ -23,395 +31,633 @@ PASSWORD = os.getenv("j_password")
 LOGIN_URL = "https://pacs.imagoradiologia.com.br/Netris-web/login"
 TOTEM_URL = "https://pacs.imagoradiologia.com.br/Netris-web/gerenciamentoTotem/atendimentosTotemPorChegada"
 
-async def login_to_pacs(headless: bool = True, 
+# Filter values that leave every dropdown unfiltered (read-only, shared by all callers)
+DEFAULT_FILTER_OPTIONS = MappingProxyType({
+    "grupo_totem": "Selecione um grupo totem",
+    "guiche": "Selecione um guichê",
+    "tipo": "Selecione um tipo",
+    "prioridade": "Selecione uma prioridade",
+    "modalidade": "Selecione uma modalidade"
+})
+
+# How each filter is set: the <select> behind its Chosen dropdown (None: find it by its placeholder option),
+# and the dropdown and exact-text option to click when the <select> can't be set directly
+FILTER_SPECS = MappingProxyType({
+    "grupo_totem": ("#slGrupoTotem", "#slGrupoTotem_chosen", "#slGrupoTotem_chosen li.active-result:text-is('{label}')"),
+    "guiche": ("#guiche", "#guiche_chosen a", "#guiche_chosen li.active-result:text-is('{label}')"),
+    "tipo": (None, "a.chosen-single:text-is('{placeholder}')", "li.active-result:text-is('{label}')"),
+    "prioridade": (None, "a.chosen-single:text-is('{placeholder}')", "li.active-result:text-is('{label}')"),
+    "modalidade": (None, "a.chosen-single:text-is('{placeholder}')", "li.active-result:text-is('{label}')")
+})
+
+# Sets every filter <select> in a single round trip and refreshes its Chosen dropdown.
+# Returns the keys of the filters that could not be set.
+APPLY_FILTERS_JS = '''(filters) => {
+    const missing = [];
+    for (const f of filters) {
+        let select = f.select ? document.querySelector(f.select) : null;
+        if (!select) {
+            select = Array.from(document.querySelectorAll('select')).find(s =>
+                s.dataset.placeholder === f.placeholder ||
+                Array.from(s.options).some(o => o.text.trim() === f.placeholder));
+        }
+        const option = select && Array.from(select.options).find(o => o.text.trim() === f.label);
+        if (!option) {
+            missing.push(f.key);
+            continue;
+        }
+        select.value = option.value;
+        if (window.jQuery) {
+            window.jQuery(select).trigger('change').trigger('chosen:updated').trigger('liszt:updated');
+        } else {
+            select.dispatchEvent(new Event('change', {bubbles: true}));
+        }
+    }
+    return missing;
+}'''
+
+# Scrolls to the element matching a CSS selector and clicks it, returning false if it can't be found.
+# Sends the whole mousedown/mouseup/click sequence, since Chosen dropdowns react to mousedown and mouseup.
+SCROLL_AND_CLICK_JS = '''(selector) => {
+    let el;
+    try {
+        el = document.querySelector(selector);
+    } catch (e) {
+        return false;
+    }
+    if (!el) return false;
+    el.scrollIntoView({block: 'center'});
+    for (const type of ['mousedown', 'mouseup', 'click']) {
+        el.dispatchEvent(new MouseEvent(type, {bubbles: true, cancelable: true, view: window}));
+    }
+    return true;
+}'''
+
+# Resources the scraper never looks at; stylesheets are kept since clicks and screenshots depend on the layout
+BLOCKED_RESOURCE_TYPES = frozenset({"image", "font", "media"})
+
+# Analytics and tracking hosts (and their subdomains) whose requests are dropped
+BLOCKED_HOSTS = (
+    "google-analytics.com",
+    "googletagmanager.com",
+    "doubleclick.net",
+    "facebook.net",
+    "hotjar.com",
+    "clarity.ms"
+)
+
+async def block_unneeded_requests(route: Route) -> None:
+    """Aborts requests for resources the scraper doesn't need and lets every other request through."""
+    request = route.request
+    host = urlparse(request.url).hostname or ""
+    if request.resource_type in BLOCKED_RESOURCE_TYPES or host.endswith(BLOCKED_HOSTS):
+        await route.abort()
+    else:
+        await route.continue_()
+
+def is_table_response(response: Response) -> bool:
+    """Tells whether a response is an AJAX call of the Totem management pages, such as the table data."""
+    return response.request.resource_type in ("xhr", "fetch") and "/gerenciamentoTotem/" in response.url
+
+# "Processing..." indicator DataTables shows while it loads the table
+TABLE_PROCESSING = "#dataTableAtendimentosTotem_processing"
+
+# Evaluates to the DataTables API of the Atendimentos table, falling back to the first DataTable of the page (or null)
+FIND_DATATABLE_JS = '''(() => {
+    const $ = window.jQuery;
+    if ($.fn.dataTable.isDataTable('#dataTableAtendimentosTotem')) return $('#dataTableAtendimentosTotem').DataTable();
+    const tables = $.fn.dataTable.tables();
+    return tables.length ? $(tables[0]).DataTable() : null;
+})()'''
+
+# Shows every row of the DataTables table on a single page and resolves with the number of pages left to read,
+# or null if the table isn't managed by DataTables. When the server caps the page size, the table is paged
+# using the largest page it serves instead, or its original page length if it ignores length -1.
+# If any redraw doesn't happen within the timeout (ms), the table gets its original page length back and -1 is resolved.
+DATATABLE_SHOW_ALL_JS = '''(timeout) => new Promise(resolve => {
+    const $ = window.jQuery;
+    if (!$ || !$.fn.dataTable || !$.fn.dataTable.Api) return resolve(null);
+    const table = ''' + FIND_DATATABLE_JS + ''';
+    if (table === null) return resolve(null);
+    const original = table.page.len();
+    const redraw = (length, done) => {
+        const onDraw = () => {
+            clearTimeout(timer);
+            done();
+        };
+        const timer = setTimeout(() => {
+            table.off('draw', onDraw);
+            table.page.len(original).draw();
+            resolve(-1);
+        }, timeout);
+        table.one('draw', onDraw);
+        table.page.len(length).draw();
+    };
+    redraw(-1, () => {
+        const shown = table.rows({page: 'current'}).count();
+        const total = table.page.info().recordsDisplay;
+        if (total === 0 || shown >= total) return resolve(1);
+        redraw(shown > 0 ? shown : original, () => resolve(table.page.info().pages));
+    });
+})'''
+
+# Next page buttons of common pagination widgets, in order of preference
+PAGINATION_NEXT_SELECTORS = (
+    "a.next",
+    "a.pagination-next",
+    "li.next a",
+    "button.next",
+    ".pagination .next",
+    "[aria-label='Next page']",
+    ".paginate_button.next",
+    "#dataTableAtendimentosTotem_next",
+    ".dataTables_paginate .next"
+)
+
+# Maximum time to wait for the DataTables table to redraw (seconds)
+DRAW_TIMEOUT = 30
+
+# Shows the given page (0-based) of the DataTables table and resolves once it has been drawn
+DATATABLE_GOTO_PAGE_JS = '''(index) => new Promise(resolve => {
+    const table = ''' + FIND_DATATABLE_JS + ''';
+    table.one('draw', () => resolve(true));
+    table.page(index).draw('page');
+})'''
+
+# Returns the text of the table headers, falling back to the first row when there is no <thead>
+EXTRACT_HEADERS_JS = '''() => {
+    let cells = document.querySelectorAll('table thead th');
+    if (cells.length === 0) {
+        cells = document.querySelectorAll('table tr:first-child th, table tr:first-child td');
+    }
+    return Array.from(cells).map(c => c.innerText.trim());
+}'''
+
+def build_rows_js(headers: List[str]) -> str:
+    """
+    Generates the script that turns the matched <tr> elements into row dictionaries,
+    with one property per table column, skipping rows whose cells are all blank.
+    
+    Args:
+        headers: The table headers, in column order
+        
+    Returns:
+        The JavaScript function, taking the list of <tr> elements
+    """
+    fields = ", ".join(
+        f"{orjson.dumps(header).decode()}: c[{i}] ? c[{i}].innerText.trim() : ''"
+        for i, header in enumerate(headers)
+    )
+    return f"rows => rows.map(tr => {{ const c = tr.cells; return {{{fields}}}; }}).filter(row => Object.values(row).some(Boolean))"
+
+# Evaluates to the <tr> elements of the table body, or of the whole table minus its header row if it has no <tbody>
+TABLE_ROWS_EXPR = '''(() => {
+    const rows = document.querySelectorAll('table tbody tr');
+    return Array.from(rows.length ? rows : document.querySelectorAll('table tr:not(:first-child)'));
+})()'''
+
+async def cdp_evaluate(cdp: CDPSession, expression: str) -> Any:
+    """
+    Evaluates a JavaScript expression in the page through the Chrome DevTools Protocol,
+    without going through Playwright's selector engine and actionability checks.
+    
+    Args:
+        cdp: CDP session attached to the page
+        expression: The expression to evaluate
+        
+    Returns:
+        The value of the expression
+    """
+    response = await cdp.send("Runtime.evaluate", {"expression": expression, "returnByValue": True})
+    if "exceptionDetails" in response:
+        details = response["exceptionDetails"]
+        raise RuntimeError(details.get("exception", {}).get("description") or details.get("text"))
+    return response["result"].get("value")
+
+# Maximum number of scraping sessions sharing one browser at the same time
+BROWSER_CONCURRENCY = int(os.getenv("BROWSER_CONCURRENCY", "4"))
+
+async def resolver_args() -> List[str]:
+    """
+    Resolves the PACS host once, without blocking the event loop, and pins the address in Chromium
+    so the browser doesn't look it up again on every navigation.
+    Only meant for browsers that live for a single run: the pin ignores the DNS TTL, and the pooled
+    browser relies on Chromium's own DNS cache instead.
+    
+    Returns:
+        The Chromium command line arguments, empty if the host could not be resolved
+    """
+    host = urlparse(LOGIN_URL).hostname
+    try:
+        # IPv4 only: pinning an IPv6 address would remove Chromium's fallback to IPv4 on hosts without an IPv6 route
+        addresses = await asyncio.get_running_loop().getaddrinfo(
+            host, 443, family=socket.AF_INET, type=socket.SOCK_STREAM
+        )
+    except OSError as e:
+        print(f"Could not resolve {host}, leaving it to the browser: {e}")
+        return []
+    ip = addresses[0][4][0]
+    return [f"--host-resolver-rules=MAP {host} {ip}"]
+
+def write_json(path: str, rows: List[Dict[str, str]]) -> None:
+    """Writes the scraped rows to a JSON file."""
+    with open(path, 'wb') as jsonfile:
+        jsonfile.write(orjson.dumps(rows))
+
+async def write_html(path: str, html: str) -> None:
+    """Writes the table HTML to a file without blocking the event loop."""
+    async with aiofiles.open(path, 'w', encoding='utf-8') as htmlfile:
+        await htmlfile.write(html)
+
+class BrowserPool:
+    """
+    Headless browser and login sessions shared by the scraping runs of one process.
+    Every run still gets its own context, so concurrent runs never see each other's cookies;
+    the cookies of a successful login are kept per account and loaded into the next context.
+    """
+    
+    def __init__(self, concurrency: int = BROWSER_CONCURRENCY):
+        self._playwright: Optional[Playwright] = None
+        self._browser: Optional[Browser] = None
+        self._lock = asyncio.Lock()
+        self._sessions: Dict[Tuple[str, str], Dict[str, Any]] = {}
+        # Limits how many runs use the browser at the same time
+        self.slots = asyncio.Semaphore(concurrency)
+    
+    async def get_browser(self) -> Browser:
+        """Returns the shared browser, launching it on first use or after it crashed."""
+        async with self._lock:
+            if self._playwright is None:
+                self._playwright = await async_playwright().start()
+            if self._browser is None or not self._browser.is_connected():
+                self._browser = await self._playwright.chromium.launch(headless=True)
+        return self._browser
+    
+    def get_session(self, username: str, password: str) -> Optional[Dict[str, Any]]:
+        """Returns the storage state saved after the last login of an account, if any."""
+        return self._sessions.get((username, password))
+    
+    def save_session(self, username: str, password: str, state: Dict[str, Any]) -> None:
+        """Keeps the storage state of a logged-in account for the next runs."""
+        self._sessions[(username, password)] = state
+    
+    def drop_session(self, username: str, password: str) -> None:
+        """Forgets the storage state of an account, e.g. after its session expired."""
+        self._sessions.pop((username, password), None)
+    
+    async def close(self) -> None:
+        """Closes the shared browser and stops Playwright."""
+        async with self._lock:
+            if self._browser is not None:
+                await self._browser.close()
+                self._browser = None
+            if self._playwright is not None:
+                await self._playwright.stop()
+                self._playwright = None
+
+async def login_to_pacs(username: Optional[str] = None,
+                        password: Optional[str] = None,
+                        headless: bool = True, 
                         viewport_width: int = 1280, 
                         viewport_height: int = 800,
-                        filter_options: Optional[Dict[str, str]] = None) -> Dict[str, Any]:
+                        filter_options: Optional[Dict[str, str]] = None,
+                        pool: Optional[BrowserPool] = None,
+                        progress_cb: Optional[Callable[[Dict[str, Any]], Awaitable[None]]] = None,
+                        debug: bool = False) -> Dict[str, Any]:
     """
     Automates the login process for PACS Imago Radiologia.
     Uses Playwright to navigate to the login page and fill in credentials.
     
     Args:
+        username: Username for PACS login
+        password: Password for PACS login
         headless: Whether to run browser in headless mode
         viewport_width: Width of browser viewport
         viewport_height: Height of browser viewport
         filter_options: Dictionary with filter options for the dropdown menus
+        pool: Shared browser pool for headless runs; a new browser is launched if not given
+        progress_cb: Coroutine function called with a progress event after each stage
+        debug: Whether to save screenshots and the table HTML for debugging
         
     Returns:
         Dictionary with scraped data and status information
     """
     print("Starting login automation...")
     
+    async def report(stage: str, **details: Any) -> None:
+        """Sends a progress event to the caller, if it asked for them."""
+        if progress_cb is not None:
+            await progress_cb({"status": "running", "stage": stage, **details})
+    
+    # Start time of this run (UTC), used for the result and the file names
+    now = datetime.datetime.now(datetime.timezone.utc)
+    timestamp = now.strftime("%Y%m%d_%H%M%S")
+    
     # Initialize result dictionary
     result = {
         "status": "failed",
         "data": [],
         "message": "",
-        "timestamp": datetime.datetime.now().isoformat()
+        "timestamp": now.isoformat()
     }
     
+    # Never log in without credentials from the caller
+    if not username or not password:
+        error_msg = "Error: Username or password not provided."
+        print(error_msg)
+        result["message"] = error_msg
+        return result
+    
+    # Unique ID for the files of this run, so concurrent runs never overwrite each other
+    run_id = uuid.uuid4().hex
+    
     # Use default filter options if none provided
     if filter_options is None:
-        filter_options = {
-            "grupo_totem": "Selecione um grupo totem",
-            "guiche": "Selecione um guichê",
-            "tipo": "Selecione um tipo",
-            "prioridade": "Selecione uma prioridade",
-            "modalidade": "Selecione uma modalidade"
-        }
+        filter_options = DEFAULT_FILTER_OPTIONS
     
-    async with async_playwright() as p:
-        # Launch browser
-        browser = await p.chromium.launch(headless=headless)
+    async with AsyncExitStack() as stack:
+        # The pool only holds a headless browser
+        if pool is not None and headless:
+            browser = await pool.get_browser()
+            storage_state = pool.get_session(username, password)
+        else:
+            # Launch a dedicated browser, closed when the session ends
+            p = await stack.enter_async_context(async_playwright())
+            browser = await p.chromium.launch(headless=headless, args=await resolver_args())
+            stack.push_async_callback(browser.close)
+            storage_state = None
+        
+        # Create a new context with specified viewport size, reusing a saved login if there is one
+        context = await browser.new_context(
+            viewport={"width": viewport_width, "height": viewport_height},
+            storage_state=storage_state
+        )
         
-        # Create a new context with specified viewport size
-        context = await browser.new_context(viewport={"width": viewport_width, "height": viewport_height})
+        # Don't download images, fonts, media or trackers
+        await context.route("**/*", block_unneeded_requests)
         
         # Open a new page
         page = await context.new_page()
         
         try:
-            # Navigate to the login page
-            print(f"Navigating to {LOGIN_URL}...")
-            await page.goto(LOGIN_URL)
-            
-            # Wait for the login form to be visible
-            await page.wait_for_selector('input[name="j_username"]')
-            
-            # Check if credentials are available
-            if not USERNAME or not PASSWORD:
-                error_msg = "Error: Username or password not found in environment variables."
-                print(error_msg)
-                result["message"] = error_msg
-                return result
-            
-            # Fill in the username and password
-            print("Filling in credentials...")
-            await page.fill('input[name="j_username"]', USERNAME)
-            await page.fill('input[name="j_password"]', PASSWORD)
-            
-            # Click the login button
-            print("Submitting login form...")
-            await page.click('button[type="submit"]')
-            
-            # Simple wait for page to load after login
-            print("Waiting for page to load after login...")
-            await page.wait_for_load_state("networkidle")
-            
-            # Wait for 5 seconds
-            print("Waiting for 5 seconds...")
-            await asyncio.sleep(5)
-            
-            # Navigate to the Totem management page
-            print(f"Navigating to {TOTEM_URL}...")
-            await page.goto(TOTEM_URL)
-            print("Navigation completed")
-            
-            # Wait for the page to fully load
-            await page.wait_for_load_state("networkidle")
-            print("Page fully loaded")
+            logged_in = False
+            if storage_state is not None:
+                # Try the saved session first, it is still valid unless we get sent back to the login page
+                print(f"Navigating to {TOTEM_URL} with the saved session...")
+                await page.goto(TOTEM_URL)
+                logged_in = "/login" not in page.url
+                if logged_in:
+                    print("Saved session is still valid, skipping login")
+                    await report("login_ok", reused_session=True)
+                else:
+                    print("Saved session expired, logging in again...")
+                    pool.drop_session(username, password)
             
-            # Scroll to and click the Salvar button
-            print("Scrolling to and clicking the Salvar button...")
-            salvar_button = page.locator("#btnSetGuicheModal")
-            
-            # Check if the button exists
-            if await salvar_button.count() > 0:
-                # Scroll the button into view before clicking
-                await salvar_button.scroll_into_view_if_needed()
-                await asyncio.sleep(1)
-                await salvar_button.click()
-                print("Clicked Salvar button")
-            else:
-                # Try alternative method if the button isn't found
-                print("Salvar button not found with first selector, trying JavaScript approach...")
-                await page.evaluate('''() => {
-                    const button = document.querySelector('#btnSetGuicheModal');
-                    if (button) {
-                        button.scrollIntoView();
-                        setTimeout(() => button.click(), 500);
-                    }
-                }''')
-                await asyncio.sleep(2)
-                print("Executed JavaScript click on Salvar button")
-            
-            # Wait for the page to update
-            await asyncio.sleep(2)
-            
-            # Apply all filters using the exact selectors from Playwright Inspector
-            print("Applying filters...")
+            if not logged_in:
+                # Navigate to the login page
+                print(f"Navigating to {LOGIN_URL}...")
+                await page.goto(LOGIN_URL)
+            
+                # Wait for the login form to be visible
+                await page.wait_for_selector('input[name="j_username"]')
+            
+                # Fill in the username and password
+                print("Filling in credentials...")
+                await page.fill('input[name="j_username"]', username)
+                await page.fill('input[name="j_password"]', password)
+            
+                # Click the login button
+                print("Submitting login form...")
+                await page.click('button[type="submit"]')
+            
+                # Wait until the site redirects away from the login page
+                print("Waiting for page to load after login...")
+                await page.wait_for_url(lambda url: "/login" not in url, timeout=15000)
+            
+                await report("login_ok")
             
-            # Helper function to scroll to element and click
+                # Navigate to the Totem management page
+                print(f"Navigating to {TOTEM_URL}...")
+                await page.goto(TOTEM_URL)
+                print("Navigation completed")
+                
+                # Keep the session of this account for the next runs
+                if pool is not None and headless and "/login" not in page.url:
+                    pool.save_session(username, password, await context.storage_state())
+            
+            # Wait for the filter form to be ready
+            await page.wait_for_selector("#btnFiltrar")
+            print("Page fully loaded")
+            
+            # Helper function to scroll to element and click, in a single call when possible
             async def scroll_and_click(selector, description):
                 print(f"Scrolling to and clicking {description}...")
-                element = page.locator(selector)
-                
-                # Check if the element exists
-                if await element.count() > 0:
-                    await element.scroll_into_view_if_needed()
-                    await asyncio.sleep(1)
-                    await element.click()
+                if await page.evaluate(SCROLL_AND_CLICK_JS, selector):
                     print(f"Clicked {description}")
                     return True
-                else:
+                
+                # Selectors only Playwright understands (e.g. :has-text) end up here
+                try:
+                    await page.locator(selector).first.click(timeout=5000)
+                except Exception:
                     print(f"{description} not found with selector {selector}")
-                    # Try JavaScript approach as fallback
-                    success = await page.evaluate(f'''() => {{
-                        const el = document.querySelector('{selector}');
-                        if (el) {{
-                            el.scrollIntoView();
-                            setTimeout(() => el.click(), 500);
-                            return true;
-                        }}
-                        return false;
-                    }}''')
-                    
-                    if success:
-                        print(f"Clicked {description} using JavaScript")
-                        await asyncio.sleep(1)
-                        return True
                     return False
+                print(f"Clicked {description} using Playwright")
+                return True
             
-            # 1. Select from the grupo totem dropdown
-            await scroll_and_click("#slGrupoTotem_chosen", "grupo totem dropdown")
-            await asyncio.sleep(1)
-            await scroll_and_click(f"#slGrupoTotem_chosen li:has-text('{filter_options['grupo_totem']}')", f"{filter_options['grupo_totem']} option")
-            
-            # 2. Select from the guichê dropdown
-            await scroll_and_click("#guiche_chosen a", "guichê dropdown")
-            await asyncio.sleep(1)
-            await scroll_and_click(f"#guiche_chosen li:has-text('{filter_options['guiche']}')", f"{filter_options['guiche']} option")
-            
-            # 3. Select from the tipo dropdown
-            await scroll_and_click(f"a:has-text('{filter_options['tipo']}')", "tipo dropdown")
-            await asyncio.sleep(1)
-            await scroll_and_click(f"li:has-text('{filter_options['tipo']}')", f"{filter_options['tipo']} option")
-            
-            # 4. Select from the prioridade dropdown
-            await scroll_and_click(f"a:has-text('{filter_options['prioridade']}')", "prioridade dropdown")
-            await asyncio.sleep(1)
-            await scroll_and_click(f"li:has-text('{filter_options['prioridade']}')", f"{filter_options['prioridade']} option")
-            
-            # 5. Select from the modalidade dropdown
-            await scroll_and_click(f"a:has-text('{filter_options['modalidade']}')", "modalidade dropdown")
-            await asyncio.sleep(1)
-            await scroll_and_click(f"li:has-text('{filter_options['modalidade']}')", f"{filter_options['modalidade']} option")
-            
-            # Click the Filtrar button
-            print("Scrolling to and clicking the Filtrar button...")
-            filtrar_button = page.locator("#btnFiltrar")
-            
-            # Check if the button exists
-            if await filtrar_button.count() > 0:
-                await filtrar_button.scroll_into_view_if_needed()
-                await asyncio.sleep(1)
-                await filtrar_button.click()
-                print("Clicked Filtrar button")
-            else:
-                # Try alternative method if the button isn't found
-                print("Filtrar button not found with first selector, trying JavaScript approach...")
-                await page.evaluate('''() => {
-                    const button = document.querySelector('#btnFiltrar');
-                    if (button) {
-                        button.scrollIntoView();
-                        setTimeout(() => button.click(), 500);
-                    }
-                }''')
-                await asyncio.sleep(2)
-                print("Executed JavaScript click on Filtrar button")
-            
-            # Wait for the table to load
+            # Click the Salvar button
+            await scroll_and_click("#btnSetGuicheModal", "Salvar button")
+            
+            # Wait for the modal to close (returns at once if the page has no modal open)
+            await page.wait_for_selector(".modal-backdrop", state="detached", timeout=5000)
+            
+            # Apply all filters directly on their <select> elements in one call
+            print("Applying filters...")
+            missing_filters = await page.evaluate(APPLY_FILTERS_JS, [
+                {
+                    "key": key,
+                    "select": select,
+                    "placeholder": DEFAULT_FILTER_OPTIONS[key],
+                    "label": filter_options[key]
+                }
+                for key, (select, _, _) in FILTER_SPECS.items()
+            ])
+            
+            # Fall back to clicking through the dropdowns
+            for key in missing_filters:
+                print(f"Could not set {key} filter directly, using the dropdown...")
+                _, dropdown, option = FILTER_SPECS[key]
+                label = filter_options[key]
+                await scroll_and_click(dropdown.format(placeholder=DEFAULT_FILTER_OPTIONS[key]), f"{key} dropdown")
+                await scroll_and_click(option.format(label=label), f"{label} option")
+            
+            # Click the Filtrar button and wait for the table data it requests
+            try:
+                async with page.expect_response(is_table_response, timeout=15000):
+                    await scroll_and_click("#btnFiltrar", "Filtrar button")
+            except PlaywrightTimeoutError:
+                print("No table request seen after Filtrar, waiting for the table itself")
+            
+            await report("filters_applied")
+            
+            # Wait for the table to be drawn
             print("Waiting for table to load...")
-            await asyncio.sleep(3)
-            await page.wait_for_load_state("networkidle")
+            await page.wait_for_selector("table tbody tr")
+            await page.wait_for_selector(TABLE_PROCESSING, state="hidden")
             
             # Scrape the table data
             print("Scraping table data...")
             
-            # First, try to get the table headers
-            headers = []
-            header_elements = page.locator("table thead th")
-            header_count = await header_elements.count()
-            
-            if header_count == 0:
-                print("No headers found with selector 'table thead th', trying alternative selector...")
-                header_elements = page.locator("table tr:first-child th, table tr:first-child td")
-                header_count = await header_elements.count()
-            
-            for i in range(header_count):
-                header_text = await header_elements.nth(i).inner_text()
-                headers.append(header_text.strip())
+            # First, get the table headers in a single call
+            headers = await page.evaluate(EXTRACT_HEADERS_JS)
             
             print(f"Found {len(headers)} table headers: {headers}")
             
+            # Expression reading the rows, generated for these headers and sent straight over CDP
+            rows_expression = f"({build_rows_js(headers)})({TABLE_ROWS_EXPR})"
+            cdp = await context.new_cdp_session(page)
+            
             # Initialize empty list for all rows across all pages
             all_rows = []
+            
+            # Export data to CSV as the pages are scraped
+            csv_filename = f"table_data_{timestamp}_{run_id}.csv"
+            print(f"Exporting data to CSV: {csv_filename}")
+            csvfile = stack.enter_context(open(csv_filename, 'w', newline='', encoding='utf-8'))
+            writer = csv.writer(csvfile)
+            if headers:
+                writer.writerow(headers)
+            
+            # Helper function to collect the rows of the page currently shown
+            async def collect_rows(page_number):
+                print(f"Processing page {page_number}...")
+                
+                # Get the non-empty rows of the current page as dictionaries in a single call
+                page_rows = await cdp_evaluate(cdp, rows_expression)
+                all_rows.extend(page_rows)
+                writer.writerows([row.get(header, "") for header in headers] for row in page_rows)
+                print(f"Processed {len(page_rows)} rows on page {page_number}")
+                
+                await report(f"page_{page_number}_scraped", rows=len(page_rows))
+            
+            # Show all rows at once through the DataTables API when it is available,
+            # jumping straight to each page if the server limits how many rows it returns
+            try:
+                page_count = await asyncio.wait_for(
+                    page.evaluate(DATATABLE_SHOW_ALL_JS, DRAW_TIMEOUT * 1000), 2 * DRAW_TIMEOUT + 5
+                )
+            except asyncio.TimeoutError:
+                page_count = -1
+            if page_count == -1:
+                # Let a table that rejected the single page finish redrawing with its original page length
+                print("DataTables did not show all rows, clicking through the pages instead")
+                await page.wait_for_selector(TABLE_PROCESSING, state="hidden")
+                page_count = None
+            elif page_count is not None:
+                print(f"Table has {page_count} pages")
+                for page_index in range(max(page_count, 1)):
+                    if page_index > 0:
+                        try:
+                            await asyncio.wait_for(page.evaluate(DATATABLE_GOTO_PAGE_JS, page_index), DRAW_TIMEOUT)
+                        except asyncio.TimeoutError:
+                            raise RuntimeError(
+                                f"DataTables did not redraw page {page_index + 1} within {DRAW_TIMEOUT}s"
+                            ) from None
+                    await collect_rows(page_index + 1)
+            
+            # Otherwise, click through the pagination controls
             current_page = 1
-            has_more_pages = True
+            has_more_pages = page_count is None
+            
+            # Find the next page button once, using the first selector that matches anything
+            next_button = None
+            if has_more_pages:
+                next_selector = await page.evaluate(
+                    "selectors => selectors.find(s => document.querySelector(s) !== null) || null",
+                    PAGINATION_NEXT_SELECTORS
+                )
+                if next_selector is not None:
+                    print(f"Using pagination button {next_selector}")
+                    next_button = page.locator(next_selector).first
             
             # Process all pages of the table
             while has_more_pages:
-                print(f"Processing page {current_page}...")
-                
-                # Get the table rows for the current page
-                row_elements = page.locator("table tbody tr")
-                row_count = await row_elements.count()
-                
-                if row_count == 0:
-                    print("No rows found with selector 'table tbody tr', trying alternative selector...")
-                    row_elements = page.locator("table tr:not(:first-child)")
-                    row_count = await row_elements.count()
-                
-                print(f"Found {row_count} table rows on page {current_page}")
-                
-                # Process rows on the current page
-                page_rows = []
-                for r in range(row_count):
-                    row = row_elements.nth(r)
-                    row_data = {}
-                    cell_elements = row.locator("td")
-                    cell_count = await cell_elements.count()
-                    
-                    # If no cells found, try th as well (some tables use th for all cells)
-                    if cell_count == 0:
-                        cell_elements = row.locator("td, th")
-                        cell_count = await cell_elements.count()
-                    
-                    for c in range(cell_count):
-                        if c < len(headers):
-                            cell_text = await cell_elements.nth(c).inner_text()
-                            row_data[headers[c]] = cell_text.strip()
-                    
-                    # Only add non-empty rows
-                    if row_data:
-                        page_rows.append(row_data)
-                        all_rows.append(row_data)
-                        print(f"Processed row {r+1}/{row_count} on page {current_page}")
-                
-                # Check for pagination elements
-                # Common pagination patterns: "Next" button, page numbers, etc.
-                pagination_next = page.locator("a.next, a.pagination-next, li.next a, button.next, .pagination .next, [aria-label='Next page'], .paginate_button.next")
-                
-                # Also check for DataTables specific pagination (common in many web applications)
-                if await pagination_next.count() == 0:
-                    pagination_next = page.locator("#dataTableAtendimentosTotem_next, .dataTables_paginate .next")
+                await collect_rows(current_page)
                 
                 # Check if there's a next page and if it's enabled/clickable
                 has_more_pages = False
-                if await pagination_next.count() > 0:
-                    # Check if the next button is disabled
-                    is_disabled = await pagination_next.first.get_attribute("class")
-                    if is_disabled and ("disabled" in is_disabled or "inactive" in is_disabled):
-                        print("Next page button is disabled, reached the last page")
-                    else:
-                        print(f"Clicking to navigate to page {current_page + 1}...")
-                        try:
-                            # Take screenshot before clicking for debugging
-                            await page.screenshot(path=f"before_pagination_page_{current_page}.png")
-                            
-                            # Scroll to the pagination element and click
-                            await pagination_next.first.scroll_into_view_if_needed()
-                            await asyncio.sleep(1)
-                            await pagination_next.first.click()
-                            
-                            # Wait for the table to update
-                            await asyncio.sleep(2)
-                            await page.wait_for_load_state("networkidle")
-                            
-                            # Take screenshot after clicking for debugging
-                            await page.screenshot(path=f"after_pagination_page_{current_page}.png")
-                            
-                            current_page += 1
-                            has_more_pages = True
-                            print(f"Successfully navigated to page {current_page}")
-                        except Exception as e:
-                            print(f"Error navigating to next page: {e}")
-                            has_more_pages = False
+                if next_button is None:
+                    print("No pagination found, the table has a single page")
+                elif await next_button.evaluate("el => el.closest('.disabled, .inactive, [disabled]') !== null"):
+                    print("Next page button is disabled, reached the last page")
                 else:
-                    # Try JavaScript approach to find and click next page button
-                    print("No standard pagination elements found, trying JavaScript approach...")
-                    has_next_page = await page.evaluate('''() => {
-                        // Try various selectors for pagination
-                        const nextButtons = [
-                            document.querySelector('a.next'),
-                            document.querySelector('a.pagination-next'),
-                            document.querySelector('li.next a'),
-                            document.querySelector('button.next'),
-                            document.querySelector('.pagination .next'),
-                            document.querySelector('[aria-label="Next page"]'),
-                            document.querySelector('.paginate_button.next'),
-                            document.querySelector('#dataTableAtendimentosTotem_next')
-                        ].filter(Boolean);
+                    print(f"Clicking to navigate to page {current_page + 1}...")
+                    try:
+                        # Take screenshot before clicking for debugging
+                        if debug:
+                            await page.screenshot(path=f"before_pagination_page_{current_page}_{run_id}.png")
+                        
+                        # Remember the first row, to tell when the next page has replaced it
+                        first_row = await page.query_selector("table tbody tr, table tr:not(:first-child)")
+                        first_row_text = await first_row.inner_text() if first_row else None
+                        
+                        # Scroll to the pagination element and click
+                        await next_button.scroll_into_view_if_needed()
+                        await next_button.click()
                         
-                        if (nextButtons.length > 0) {
-                            const nextButton = nextButtons[0];
-                            // Check if button is disabled
-                            if (nextButton.classList.contains('disabled') || 
-                                nextButton.classList.contains('inactive') ||
-                                nextButton.getAttribute('disabled')) {
-                                return false;
-                            }
-                            
-                            // Click the button
-                            nextButton.scrollIntoView();
-                            setTimeout(() => nextButton.click(), 500);
-                            return true;
-                        }
+                        # Wait for the table to update
+                        if first_row is not None:
+                            try:
+                                await page.wait_for_function(
+                                    "([row, text]) => !row.isConnected || row.innerText !== text",
+                                    arg=[first_row, first_row_text]
+                                )
+                            except PlaywrightTimeoutError:
+                                raise
+                            except PlaywrightError:
+                                # The click loaded a new document, so the old row is gone with it
+                                await page.wait_for_load_state()
+                                await page.wait_for_selector("table tr")
+                        
+                        # Take screenshot after clicking for debugging
+                        if debug:
+                            await page.screenshot(path=f"after_pagination_page_{current_page}_{run_id}.png")
                         
-                        // No pagination found or all options exhausted
-                        return false;
-                    }''')
-                    
-                    if has_next_page:
-                        await asyncio.sleep(2)
-                        await page.wait_for_load_state("networkidle")
                         current_page += 1
                         has_more_pages = True
-                        print(f"Successfully navigated to page {current_page} using JavaScript")
-                    else:
-                        print("No pagination found or reached the last page")
+                        print(f"Successfully navigated to page {current_page}")
+                    except Exception as e:
+                        print(f"Error navigating to next page: {e}")
             
             print(f"Finished processing all pages. Total rows collected: {len(all_rows)}")
+            csvfile.close()
+            print(f"Successfully exported {len(all_rows)} rows to CSV")
             
-            # Generate timestamp for filenames
-            timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-            
-            # Export data to CSV
-            csv_filename = f"table_data_{timestamp}.csv"
-            print(f"Exporting data to CSV: {csv_filename}")
-            
-            with open(csv_filename, 'w', newline='', encoding='utf-8') as csvfile:
-                if headers and all_rows:
-                    writer = csv.DictWriter(csvfile, fieldnames=headers)
-                    writer.writeheader()
-                    writer.writerows(all_rows)
-                    print(f"Successfully exported {len(all_rows)} rows to CSV")
-                else:
-                    print("No data to export to CSV")
-            
-            # Export data to JSON
-            json_filename = f"table_data_{timestamp}.json"
+            # Export data to JSON without blocking the event loop
+            json_filename = f"table_data_{timestamp}_{run_id}.json"
             print(f"Exporting data to JSON: {json_filename}")
+            loop = asyncio.get_running_loop()
+            writes = [loop.run_in_executor(None, write_json, json_filename, all_rows)]
             
-            with open(json_filename, 'w', encoding='utf-8') as jsonfile:
-                json.dump(all_rows, jsonfile, ensure_ascii=False, indent=4)
-                print(f"Successfully exported data to JSON")
-            
-            # Also try to get the raw HTML of the table for debugging
-            print("Getting raw HTML of the table...")
-            table_html = await page.evaluate('''() => {
-                const table = document.querySelector('table');
-                return table ? table.outerHTML : 'No table found';
-            }''')
-            
-            with open(f"table_html_{timestamp}.html", 'w', encoding='utf-8') as htmlfile:
-                htmlfile.write(table_html)
-                print(f"Saved table HTML to table_html_{timestamp}.html")
+            if debug:
+                # Also get the raw HTML of the table
+                print("Getting raw HTML of the table...")
+                table_html = await page.eval_on_selector("table", "el => el.outerHTML")
+                
+                html_filename = f"table_html_{timestamp}_{run_id}.html"
+                writes.append(write_html(html_filename, table_html))
+                result["html_file"] = html_filename
+                
+                # Take a screenshot of the final state
+                print("Taking final screenshot...")
+                await page.screenshot(path=f"final_state_{run_id}.png")
+                print(f"Screenshot saved as final_state_{run_id}.png")
             
-            # Take a screenshot of the final state
-            print("Taking final screenshot...")
-            await page.screenshot(path="final_state.png")
-            print("Screenshot saved as final_state.png")
+            # The page is no longer needed, close the context while the files are written
+            await asyncio.gather(*writes, context.close())
+            print("Successfully exported data to JSON")
+            if debug:
+                print(f"Saved table HTML to {html_filename}")
             
             # Prepare successful result
             result["status"] = "success"
@@ -420,7 +666,6 @@ async def login_to_pacs(headless: bool = True,
             result["headers"] = headers
             result["csv_file"] = csv_filename
             result["json_file"] = json_filename
-            result["html_file"] = f"table_html_{timestamp}.html"
             
         except Exception as e:
             error_msg = f"An error occurred: {str(e)}"
@@ -429,7 +674,7 @@ async def login_to_pacs(headless: bool = True,
             
             # Take a screenshot to help diagnose the error
             try:
-                screenshot_path = f"error_state_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}.png"
+                screenshot_path = f"error_state_{timestamp}_{run_id}.png"
                 await page.screenshot(path=screenshot_path)
                 print(f"Error screenshot saved as {screenshot_path}")
                 result["error_screenshot"] = screenshot_path
@@ -437,17 +682,18 @@ async def login_to_pacs(headless: bool = True,
                 print("Could not take error screenshot")
         
         finally:
-            # Close the browser
-            await browser.close()
-            print("Browser closed.")
+            # Close the context (if the export hasn't already), leaving a shared browser open for other sessions
+            await context.close()
+            print("Browser context closed.")
             
         return result
 
 if __name__ == "__main__":
     # Check if credentials are set in environment variables
-    if not os.getenv("j_username") or not os.getenv("j_password"):
+    if not USERNAME or not PASSWORD:
         print("Warning: j_username and/or j_password not found in environment variables.")
         print("Please set these environment variables or create a .env file.")
     else:
-        # Run the main function
-        asyncio.run(login_to_pacs(headless=False))
\ No newline at end of file
+        # Run the main function on uvloop's faster event loop
+        uvloop.install()
+        asyncio.run(login_to_pacs(username=USERNAME, password=PASSWORD, headless=False, debug=True))
\ No newline at end of file
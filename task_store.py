@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+"""
+PACS Imago Radiologia Task Store
+This module keeps scraping task status in Redis so every API worker sees the same tasks.
+"""
+import os
+import hashlib
+import secrets
+from typing import Optional, Dict, Any
+
+import orjson
+from dotenv import load_dotenv
+from redis.asyncio import Redis
+
+# Load environment variables from .env file
+load_dotenv()
+
+# Redis connection and how long task results are kept (seconds)
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+TASK_TTL = int(os.getenv("TASK_TTL", "3600"))
+
+# How long the credentials of a queued task wait for a worker to pick them up (seconds)
+CREDENTIALS_TTL = int(os.getenv("CREDENTIALS_TTL", "900"))
+
+# Secret key of the request fingerprints, so the credentials behind them can't be brute-forced
+# from the Redis key names. Every API process must use the same key for identical requests to be coalesced.
+if os.getenv("FINGERPRINT_KEY"):
+    _FINGERPRINT_KEY = hashlib.blake2b(os.environ["FINGERPRINT_KEY"].encode(), digest_size=32).digest()
+else:
+    print("Warning: FINGERPRINT_KEY not set, identical requests are only coalesced within this process.")
+    _FINGERPRINT_KEY = secrets.token_bytes(32)
+
+def task_key(task_id: str) -> str:
+    """Redis key holding the status of a task."""
+    return f"task:{task_id}"
+
+def done_channel(task_id: str) -> str:
+    """Redis pub/sub channel notified when a task reaches a final state."""
+    return f"task:{task_id}:done"
+
+def events_channel(task_id: str) -> str:
+    """Redis pub/sub channel carrying the progress events of a running task."""
+    return f"task:{task_id}:events"
+
+def inflight_key(fingerprint: str) -> str:
+    """Redis key mapping a request fingerprint to the task currently running it."""
+    return f"inflight:{fingerprint}"
+
+def credentials_key(task_id: str) -> str:
+    """Redis key holding the PACS credentials of a queued task until a worker reads them."""
+    return f"creds:{task_id}"
+
+def request_fingerprint(request: Dict[str, Any]) -> str:
+    """
+    Identifies scraping requests that would return the same data.
+    
+    Args:
+        request: The scraping request, as produced by ScrapingRequest.model_dump()
+        
+    Returns:
+        A hex digest of the credentials and filter options
+    """
+    digest = hashlib.blake2b(digest_size=16, key=_FINGERPRINT_KEY)
+    digest.update(request["j_username"].encode())
+    digest.update(b"|")
+    digest.update(request["j_password"].encode())
+    digest.update(b"|")
+    digest.update(orjson.dumps(request.get("filter_options"), option=orjson.OPT_SORT_KEYS))
+    return digest.hexdigest()
+
+def create_redis() -> Redis:
+    """Creates the Redis client used to store task status."""
+    return Redis.from_url(REDIS_URL, decode_responses=True)
+
+async def save_task(redis: Redis, task_id: str, payload: Dict[str, Any]) -> None:
+    """
+    Stores the status of a task.
+    Running tasks have no expiry, so with the volatile-lru eviction policy they are
+    never evicted; finished tasks expire after TASK_TTL seconds.
+    """
+    ex = None if payload.get("status") == "running" else TASK_TTL
+    await redis.set(task_key(task_id), orjson.dumps(payload), ex=ex)
+
+async def load_task(redis: Redis, task_id: str) -> Optional[Dict[str, Any]]:
+    """Returns the stored status of a task, or None if it is unknown or expired."""
+    raw = await redis.get(task_key(task_id))
+    if raw is None:
+        return None
+    return orjson.loads(raw)
+
+async def finish_task(redis: Redis, task_id: str, payload: Dict[str, Any]) -> None:
+    """Stores the final status of a task and notifies subscribers of its completion."""
+    await save_task(redis, task_id, payload)
+    await redis.publish(done_channel(task_id), payload.get("status", "failed"))
+
+async def publish_event(redis: Redis, task_id: str, event: Dict[str, Any]) -> None:
+    """Publishes a progress event of a running task to its subscribers."""
+    await redis.publish(events_channel(task_id), orjson.dumps(event))
+
+async def save_credentials(redis: Redis, task_id: str, username: str, password: str) -> None:
+    """
+    Hands the PACS credentials of a task to the worker through Redis, so they never
+    travel in the queued message (which Dramatiq writes to its logs).
+    """
+    payload = orjson.dumps({"j_username": username, "j_password": password})
+    await redis.set(credentials_key(task_id), payload, ex=CREDENTIALS_TTL)
+
+async def pop_credentials(redis: Redis, task_id: str) -> Optional[Dict[str, str]]:
+    """Reads and deletes the credentials of a task, or returns None if they expired."""
+    raw = await redis.getdel(credentials_key(task_id))
+    if raw is None:
+        return None
+    return orjson.loads(raw)
+
+async def claim_inflight(redis: Redis, fingerprint: str, task_id: str) -> Optional[str]:
+    """
+    Registers task_id as the task running the given request, unless one is already running.
+    
+    Returns:
+        The ID of the task already running the same request, or None if task_id was registered
+    """
+    key = inflight_key(fingerprint)
+    if await redis.set(key, task_id, nx=True, ex=TASK_TTL):
+        return None
+    
+    # Reuse the existing task only while it is still running
+    existing_id = await redis.get(key)
+    if existing_id is not None:
+        existing = await load_task(redis, existing_id)
+        if existing is not None and existing["status"] == "running":
+            return existing_id
+    
+    await redis.set(key, task_id, ex=TASK_TTL)
+    return None
+
+async def release_inflight(redis: Redis, fingerprint: str, task_id: str) -> None:
+    """Removes the in-flight entry of a request if it still points to task_id."""
+    key = inflight_key(fingerprint)
+    if await redis.get(key) == task_id:
+        await redis.delete(key)
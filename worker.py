@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+"""
+PACS Imago Radiologia Worker
+This module runs scraping jobs outside of the API process using Dramatiq with a Redis broker.
+Start it with: dramatiq worker
+"""
+import os
+import asyncio
+from typing import Dict, Any
+
+import dramatiq
+import uvloop
+from dramatiq.asyncio import get_event_loop_thread
+from dramatiq.brokers.redis import RedisBroker
+from dramatiq.middleware import Middleware
+from dramatiq.middleware.asyncio import AsyncIO
+
+from login_automation import login_to_pacs, BrowserPool
+from task_store import (
+    REDIS_URL, create_redis, finish_task, publish_event, release_inflight, pop_credentials
+)
+
+# Run the AsyncIO middleware's event loop on uvloop
+uvloop.install()
+
+# Browser and login sessions shared by the jobs of this worker process, created lazily on the worker's event loop
+_pool = None
+
+def get_pool() -> BrowserPool:
+    """Returns the browser pool used by this worker process."""
+    global _pool
+    if _pool is None:
+        _pool = BrowserPool()
+    return _pool
+
+class ClosePool(Middleware):
+    """Closes the shared browser once the worker has finished its jobs."""
+
+    def after_worker_shutdown(self, broker, worker):
+        # after_* hooks run in reverse order, so this runs before AsyncIO stops the event loop the browser lives on
+        event_loop_thread = get_event_loop_thread()
+        if event_loop_thread is not None and _pool is not None:
+            event_loop_thread.run_coroutine(_pool.close())
+
+# Broker shared by the API (which enqueues jobs) and the workers (which run them)
+broker = RedisBroker(url=REDIS_URL)
+broker.add_middleware(AsyncIO())
+broker.add_middleware(ClosePool(), after=AsyncIO)
+dramatiq.set_broker(broker)
+
+# Maximum time a scraping job may run (milliseconds)
+SCRAPE_TIME_LIMIT = int(os.getenv("SCRAPE_TIME_LIMIT", "600000"))
+
+# Redis client for task status, created lazily on the worker's event loop
+_redis = None
+
+def get_redis():
+    """Returns the Redis client used by this worker process."""
+    global _redis
+    if _redis is None:
+        _redis = create_redis()
+    return _redis
+
+@dramatiq.actor(max_retries=0, time_limit=SCRAPE_TIME_LIMIT)
+async def scrape_job(task_id: str, fingerprint: str, request: Dict[str, Any]) -> None:
+    """
+    Runs a scraping task and stores its result.
+    The credentials are read from Redis, so they never appear in the message or the worker's logs.
+
+    Args:
+        task_id: The ID of the task to update
+        fingerprint: The fingerprint of the request, as produced by request_fingerprint()
+        request: The scraping request without its credentials
+    """
+    redis = get_redis()
+    pool = get_pool()
+
+    async def publish_progress(event: Dict[str, Any]) -> None:
+        await publish_event(redis, task_id, event)
+
+    try:
+        credentials = await pop_credentials(redis, task_id)
+        if credentials is None:
+            raise RuntimeError("Credentials expired before a worker picked up the task")
+
+        # Run the automation and get results (headless jobs run in the shared browser)
+        async with pool.slots:
+            result = await login_to_pacs(
+                username=credentials["j_username"],
+                password=credentials["j_password"],
+                headless=request["headless"],
+                viewport_width=request["viewport_width"],
+                viewport_height=request["viewport_height"],
+                filter_options=request["filter_options"],
+                pool=pool,
+                progress_cb=publish_progress
+            )
+
+    except Exception as e:
+        result = {
+            "status": "failed",
+            "message": str(e),
+            "data": []
+        }
+
+    except asyncio.CancelledError:
+        # The job was interrupted (e.g. time limit), don't leave the task running forever
+        await finish_task(redis, task_id, {
+            "status": "failed",
+            "message": "Scraping task was interrupted",
+            "data": []
+        })
+        await release_inflight(redis, fingerprint, task_id)
+        raise
+
+    # Update task status with result
+    await finish_task(redis, task_id, result)
+    await release_inflight(redis, fingerprint, task_id)